@@ -1,26 +1,143 @@
 """
 QGIS: LIDAR Workflow (Suelo + Edificaciones → DTM + edificaciones + Fill NoData)
-Pipeline completo: filtrado, fusión, rasterización y fillnodata
+Pipeline completo: filtrado + rasterización (un solo pipeline PDAL) y fillnodata
 """
 
 from qgis.PyQt.QtCore import QCoreApplication
 from qgis.core import (
     QgsProcessing, QgsProcessingAlgorithm, QgsProcessingMultiStepFeedback,
     QgsProcessingParameterFile, QgsProcessingParameterFolderDestination,
-    QgsProcessingParameterNumber, QgsProcessingParameterBoolean
+    QgsProcessingParameterNumber, QgsProcessingParameterExtent,
+    QgsCoordinateReferenceSystem
 )
+import functools
+import math
+import os
+import shutil
 import subprocess
 import json
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    import pdal
+except ImportError:
+    pdal = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+try:
+    import laspy
+except ImportError:
+    laspy = None
+
+try:
+    import rasterio
+    import rasterio.shutil
+    from rasterio.fill import fillnodata
+    from rasterio.windows import Window
+except ImportError:
+    rasterio = None
+
+# Clases ASPRS rasterizadas: suelo (2) y edificios (6)
+CLASSIFICATIONS = (2, 6)
+
+# Raster de salida de PDAL: float32 sobra para alturas LiDAR y reduce a la mitad la E/S.
+# Sin NUM_THREADS: ya se ejecuta un writer por núcleo en paralelo
+RASTER_NODATA = -9999
+RASTER_GDALOPTS = "COMPRESS=DEFLATE,TILED=YES,PREDICTOR=3,BLOCKXSIZE=512,BLOCKYSIZE=512"
+
+# Máximo de tiles por pipeline de la CLI de PDAL: reparte el arranque de cada
+# proceso pdal entre varios archivos (todos los puntos del lote quedan en memoria
+# a la vez). Con los bindings no se agrupan tiles
+TILE_BATCH_SIZE = max(1, (os.cpu_count() or 1) // 2)
+
+# Caché de bloques de GDAL (MB) durante el relleno de NoData
+GDAL_CACHEMAX_MB = 512
+
+# Índice de cabeceras LAS (bbox + número de puntos), cacheado en la carpeta de salida
+TILE_INDEX_FILENAME = '_lazindex.json'
+
+# En Windows evita crear una consola para cada subproceso
+CREATE_NO_WINDOW = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+
+
+def _pipeline_json(pipeline):
+    """Serializa un pipeline de PDAL a bytes JSON compactos (con orjson si está instalado)."""
+    if orjson is not None:
+        return orjson.dumps(pipeline)
+    return json.dumps(pipeline, separators=(',', ':')).encode()
+
+
+@functools.lru_cache(maxsize=1)
+def _detect_fillnodata():
+    """Detecta una sola vez por sesión cómo ejecutar gdal_fillnodata."""
+    # Ejecutables en el PATH: basta con shutil.which, sin lanzar procesos.
+    # Se devuelve la ruta resuelta; en Windows which también encuentra .py/.bat
+    # (vía PATHEXT) que CreateProcess no puede lanzar sin shell, así que se omiten
+    for exe in ("gdal_fillnodata", "gdal_fillnodata.py"):
+        path = shutil.which(exe)
+        if path is None:
+            continue
+        if os.name == 'nt' and path.lower().endswith(('.py', '.bat', '.cmd')):
+            continue
+        return (path,)
+
+    cmd = ("python", "-m", "osgeo_utils.gdal_fillnodata")
+    try:
+        subprocess.run(
+            [*cmd, "--help"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=5,
+            creationflags=CREATE_NO_WINDOW
+        )
+        return cmd
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class _LockedFeedback:
+    """Serializa las llamadas al feedback de QGIS, que no es thread-safe."""
+
+    def __init__(self, feedback):
+        self._feedback = feedback
+        self._lock = threading.Lock()
+
+    def pushInfo(self, info):
+        with self._lock:
+            self._feedback.pushInfo(info)
+
+    def reportError(self, error, fatalError=False):
+        with self._lock:
+            self._feedback.reportError(error, fatalError)
+
+    def setCurrentStep(self, step):
+        with self._lock:
+            self._feedback.setCurrentStep(step)
+
+    def isCanceled(self):
+        return self._feedback.isCanceled()
+
 
 class LidarWorkflowProcessor(QgsProcessingAlgorithm):
     INPUT_FOLDER = 'INPUT_FOLDER'
     OUTPUT_FOLDER = 'OUTPUT_FOLDER'
     RESOLUTION = 'RESOLUTION'
     FILL_DISTANCE = 'FILL_DISTANCE'
-    CLEANUP_TEMP = 'CLEANUP_TEMP'
+    AOI = 'AOI'
 
     def tr(self, text):
         return QCoreApplication.translate('LidarWorkflowProcessor', text)
@@ -43,11 +160,17 @@ class LidarWorkflowProcessor(QgsProcessingAlgorithm):
     def shortHelpString(self):
         return self.tr(
             'Procesa archivos LAZ/LAS:\n'
-            '1. Filtra suelo (clase 2) y edificios (clase 6)\n'
-            '2. Fusiona (merge) ambas clasificaciones\n'
-            '3. Genera raster DTM+edificaciones\n'
-            '4. Rellena NoData de los rasters generados\n\n'
-            'Requiere PDAL y GDAL instalados en el sistema.'
+            '1. Filtra suelo (clase 2) y edificios (clase 6) y genera el raster\n'
+            '   DTM+edificaciones en un único pipeline PDAL por archivo\n'
+            '2. Une los rasters en un mosaico VRT y rellena su NoData\n\n'
+            'Requiere PDAL y GDAL instalados en el sistema.\n'
+            'Si están disponibles los paquetes de Python pdal y rasterio se usan\n'
+            'en lugar de la línea de comandos (pdal pipeline, gdal_fillnodata).\n'
+            'Con el paquete pdal, al cancelar se terminan los archivos en curso.\n\n'
+            'Área de interés (opcional): se reproyecta al SRC de la nube de puntos\n'
+            '(leído de las cabeceras; si no se puede leer se avisa y se usa tal cual).\n'
+            'Se omiten los tiles fuera del área; los archivos .copc.laz se leen\n'
+            'sólo en la zona del área, el resto se lee completo y se recorta.'
         )
 
     def initAlgorithm(self, config=None):
@@ -80,10 +203,10 @@ class LidarWorkflowProcessor(QgsProcessingAlgorithm):
             maxValue=500
         ))
 
-        self.addParameter(QgsProcessingParameterBoolean(
-            self.CLEANUP_TEMP,
-            self.tr('Eliminar archivos intermedios (suelo, edificios, merged)'),
-            defaultValue=True
+        self.addParameter(QgsProcessingParameterExtent(
+            self.AOI,
+            self.tr('Área de interés (opcional)'),
+            optional=True
         ))
 
     def processAlgorithm(self, parameters, context, model_feedback):
@@ -91,124 +214,151 @@ class LidarWorkflowProcessor(QgsProcessingAlgorithm):
         output_folder = Path(self.parameterAsFileOutput(parameters, self.OUTPUT_FOLDER, context))
         resolution = self.parameterAsDouble(parameters, self.RESOLUTION, context)
         fill_distance = self.parameterAsInt(parameters, self.FILL_DISTANCE, context)
-        cleanup = self.parameterAsBoolean(parameters, self.CLEANUP_TEMP, context)
 
         nodata_folder = output_folder / 'rasters_finales_filled'
-        temp_folder = output_folder / 'temp'
         nodata_folder.mkdir(parents=True, exist_ok=True)
-        temp_folder.mkdir(parents=True, exist_ok=True)
 
-        laz_files = list(input_folder.glob("*.laz")) + list(input_folder.glob("*.las"))
+        # Una sola pasada por la carpeta; DirEntry ya trae la información de stat
+        laz_files = [
+            Path(e.path) for e in os.scandir(input_folder)
+            if e.is_file() and e.name.lower().endswith((".laz", ".las"))
+        ]
         if not laz_files:
             raise Exception("No se encontraron archivos LAZ/LAS en la carpeta")
 
-        steps = len(laz_files) * 5 + 1
-        feedback = QgsProcessingMultiStepFeedback(steps, model_feedback)
-
-        raster_outputs = []
-        current_step = 0
-
+        # Un paso por archivo para el raster; el relleno es un paso sobre el mosaico
+        # VRT, o uno por raster si GDAL no está disponible para construirlo
+        steps = len(laz_files) + (1 if gdal is not None else len(laz_files)) + 1
+        # Los hilos de trabajo escriben en el log: todas las llamadas pasan por un lock
+        feedback = _LockedFeedback(QgsProcessingMultiStepFeedback(steps, model_feedback))
+
+        # Descartar tiles vacíos leyendo sólo las cabeceras, antes de lanzar PDAL
+        tile_index = self._load_tile_index(laz_files, output_folder, feedback)
+        aoi = None
+        if parameters.get(self.AOI):
+            aoi = self._aoi_in_tiles_crs(parameters, context, tile_index, feedback)
+        pending = []
         for laz_file in laz_files:
-            if feedback.isCanceled():
-                break
-
-            base_name = laz_file.stem
-            feedback.pushInfo(f"\n{'='*50}\nProcesando: {laz_file.name}\n{'='*50}")
-
-            output_suelo = output_folder / f"{base_name}_suelo.las"
-            output_edificios = output_folder / f"{base_name}_edificios.las"
-            output_merged = output_folder / f"{base_name}_merged.las"
-            raster_output = output_folder / f"{base_name}_raster.tif"
-
-            pipeline_files = []
-
-            try:
-                # 1. Filtrar suelo
-                feedback.setCurrentStep(current_step)
-                feedback.pushInfo("Filtrando suelo (clase 2)...")
-                pipeline = self._create_filter_pipeline(laz_file, output_suelo, 2)
-                pipeline_file = temp_folder / f"pipeline_suelo_{base_name}.json"
-                pipeline_files.append(pipeline_file)
-                if not self._run_pdal_pipeline(pipeline, pipeline_file, feedback):
-                    continue
-                current_step += 1
-
-                # 2. Filtrar edificios
-                feedback.setCurrentStep(current_step)
-                feedback.pushInfo("Filtrando edificios (clase 6)...")
-                pipeline = self._create_filter_pipeline(laz_file, output_edificios, 6)
-                pipeline_file = temp_folder / f"pipeline_edificios_{base_name}.json"
-                pipeline_files.append(pipeline_file)
-                if not self._run_pdal_pipeline(pipeline, pipeline_file, feedback):
-                    continue
-                current_step += 1
+            entry = tile_index.get(str(laz_file), {})
+            if entry.get('count') == 0:
+                continue
+            if aoi is not None and 'bounds' in entry and not self._bounds_intersect(entry['bounds'], aoi):
+                continue
+            pending.append(laz_file)
+        if len(pending) < len(laz_files):
+            feedback.pushInfo(f"Omitidos {len(laz_files) - len(pending)} archivos sin puntos o fuera del área de interés")
+        if aoi is not None and any(not f.name.lower().endswith('.copc.laz') for f in pending):
+            feedback.pushInfo(
+                "Sugerencia: convierte los tiles a COPC una sola vez "
+                "(pdal translate entrada.laz salida.copc.laz) para leer sólo el área de interés"
+            )
 
-                # 3. Fusionar suelo + edificios
-                feedback.setCurrentStep(current_step)
-                feedback.pushInfo("Fusionando clasificaciones...")
-                pipeline = self._create_merge_pipeline([output_suelo, output_edificios], output_merged)
-                pipeline_file = temp_folder / f"pipeline_merge_{base_name}.json"
-                pipeline_files.append(pipeline_file)
-                if not self._run_pdal_pipeline(pipeline, pipeline_file, feedback):
-                    continue
-                current_step += 1
+        # Cada tile es independiente: se procesan en paralelo. Se usan hilos
+        # (no procesos) porque QGIS no admite multiprocessing dentro de un
+        # algoritmo; el paralelismo depende de que el trabajo pesado ocurra
+        # fuera del intérprete (código C++ de PDAL con los bindings, o los
+        # subprocesos de la CLI). Con los bindings un pipeline en curso no se
+        # puede interrumpir: al cancelar sólo se descartan los tiles pendientes.
+        raster_outputs = []
+        current_step = len(laz_files) - len(pending)
+        max_workers = min(os.cpu_count() or 1, max(len(pending), 1))
+        # Sólo se agrupan tiles con la CLI (un arranque de pdal por pipeline) y cuando
+        # sobran respecto a los hilos; en memoria agrupar sólo multiplica el pico de RAM
+        batch_size = 1
+        if pdal is None:
+            batch_size = max(1, min(TILE_BATCH_SIZE, len(pending) // max_workers))
+        batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        feedback.pushInfo(
+            f"Procesando {len(pending)} archivos con {max_workers} hilos "
+            f"({batch_size} archivo(s) por pipeline)"
+        )
 
-                # 4. Generar raster
-                feedback.setCurrentStep(current_step)
-                feedback.pushInfo("Generando raster DTM+edificaciones...")
-                pipeline = self._create_raster_pipeline(output_merged, raster_output, resolution)
-                pipeline_file = temp_folder / f"pipeline_raster_{base_name}.json"
-                pipeline_files.append(pipeline_file)
-                if not self._run_pdal_pipeline(pipeline, pipeline_file, feedback):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(
+                    self._process_tile_batch, batch, output_folder, resolution, aoi,
+                    {f: tile_index.get(str(f), {}).get('bounds') for f in batch}, feedback
+                ): batch
+                for batch in batches
+            }
+            for future in as_completed(futures):
+                if future.cancelled():
                     continue
-                current_step += 1
-
-                raster_outputs.append(raster_output)
-
-                # 5. Limpiar intermedios si se solicitó
+                batch = futures[future]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    feedback.reportError(f"Error procesando {', '.join(f.name for f in batch)}: {str(e)}")
+                    results = [(laz_file, None) for laz_file in batch]
+                for laz_file, raster_output in results:
+                    if raster_output is not None:
+                        raster_outputs.append(raster_output)
+                        feedback.pushInfo(f"✓ Completado: {laz_file.name}")
+                # Sólo el hilo principal actualiza el progreso
+                current_step += len(batch)
                 feedback.setCurrentStep(current_step)
-                if cleanup:
-                    for f in [output_suelo, output_edificios, output_merged]:
-                        if f.exists():
-                            f.unlink()
-                    feedback.pushInfo("Archivos intermedios eliminados")
-                current_step += 1
-
-                # Limpiar pipelines JSON
-                for pf in pipeline_files:
-                    if pf.exists():
-                        pf.unlink()
-
-            except Exception as e:
-                feedback.reportError(f"Error procesando {laz_file.name}: {str(e)}")
-                current_step += (5 - (current_step % 5))
-                continue
+                if feedback.isCanceled():
+                    for f in futures:
+                        f.cancel()
 
         # Rellenar NoData en los rasters generados
+        current_step = len(laz_files)
         feedback.setCurrentStep(current_step)
         if raster_outputs:
             feedback.pushInfo("\n" + "="*50)
             feedback.pushInfo("Iniciando relleno de NoData")
             feedback.pushInfo("="*50)
 
-            fillnodata_cmd = self._detect_fillnodata()
-            if fillnodata_cmd is None:
-                feedback.reportError("gdal_fillnodata no encontrado. Instala GDAL Python utilities.")
+            # rasterio rellena en el mismo proceso; gdal_fillnodata queda como alternativa
+            fillnodata_cmd = None
+            if rasterio is not None:
+                feedback.pushInfo("Usando: rasterio.fill.fillnodata")
             else:
-                feedback.pushInfo(f"Usando: {' '.join(fillnodata_cmd)}")
-                for raster_file in raster_outputs:
-                    if feedback.isCanceled():
-                        break
-                    output_nodata = nodata_folder / f"{raster_file.stem}_filled.tif"
-                    cmd = fillnodata_cmd + [
-                        "-md", str(fill_distance),
-                        "-si", "0",
-                        str(raster_file),
-                        str(output_nodata)
-                    ]
-                    if self._run_command(cmd, feedback):
-                        feedback.pushInfo(f"✓ Rellenado: {output_nodata.name}")
-
+                fillnodata_cmd = _detect_fillnodata()
+                if fillnodata_cmd is None:
+                    feedback.reportError("gdal_fillnodata no encontrado. Instala GDAL Python utilities o rasterio.")
+                else:
+                    feedback.pushInfo(f"Usando: {' '.join(fillnodata_cmd)}")
+
+            # Rellenar sobre un mosaico VRT: sin bordes entre tiles y un solo raster final
+            fill_inputs = raster_outputs
+            vrt_file = self._build_vrt(raster_outputs, output_folder, feedback)
+            if vrt_file is not None:
+                feedback.pushInfo(f"Mosaico virtual: {vrt_file.name}")
+                fill_inputs = [vrt_file]
+
+            if rasterio is not None or fillnodata_cmd is not None:
+                # Un raster por hilo; los bloques de cada raster se reparten los núcleos restantes
+                cpus = os.cpu_count() or 1
+                max_workers = min(cpus, len(fill_inputs))
+                tile_workers = max(1, cpus // max_workers)
+                with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    futures = {
+                        executor.submit(
+                            self._fill_nodata, raster_file,
+                            nodata_folder / f"{raster_file.stem}_filled.tif",
+                            fill_distance, fillnodata_cmd, tile_workers, feedback
+                        ): raster_file
+                        for raster_file in fill_inputs
+                    }
+                    for future in as_completed(futures):
+                        if future.cancelled():
+                            continue
+                        raster_file = futures[future]
+                        try:
+                            filled = future.result()
+                        except Exception as e:
+                            feedback.reportError(f"Error rellenando {raster_file.name}: {str(e)}")
+                            filled = False
+                        if filled:
+                            feedback.pushInfo(f"✓ Rellenado: {raster_file.stem}_filled.tif")
+                        current_step += 1
+                        feedback.setCurrentStep(min(current_step, steps - 1))
+                        if feedback.isCanceled():
+                            for f in futures:
+                                f.cancel()
+
+        feedback.setCurrentStep(steps - 1)
         feedback.pushInfo(f"\nProceso completado: {len(raster_outputs)}/{len(laz_files)} archivos")
         return {
             self.OUTPUT_FOLDER: str(output_folder),
@@ -216,93 +366,376 @@ class LidarWorkflowProcessor(QgsProcessingAlgorithm):
             'TOTAL_COUNT': len(laz_files)
         }
 
-    def _create_filter_pipeline(self, input_file, output_file, classification):
-        return {
-            "pipeline": [
-                str(input_file),
-                {"type": "filters.range", "limits": f"Classification[{classification}:{classification}]"},
-                str(output_file)
-            ]
-        }
+    def _load_tile_index(self, laz_files, output_folder, feedback):
+        """Devuelve {ruta: {bounds, count, wkt, size, mtime}}; sólo relee las cabeceras que cambiaron."""
+        index_file = output_folder / TILE_INDEX_FILENAME
+        try:
+            with open(index_file) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = {}
+
+        index = {}
+        for laz_file in laz_files:
+            key = str(laz_file)
+            stat = laz_file.stat()
+            entry = cached.get(key)
+            if (entry is None or 'wkt' not in entry
+                    or entry.get('size') != stat.st_size or entry.get('mtime') != stat.st_mtime_ns):
+                header = self._read_las_header(laz_file, feedback)
+                if header is None:
+                    continue
+                entry = dict(header, size=stat.st_size, mtime=stat.st_mtime_ns)
+            index[key] = entry
+
+        try:
+            with open(index_file, 'w') as f:
+                json.dump(index, f)
+        except OSError as e:
+            feedback.reportError(f"No se pudo guardar {index_file.name}: {str(e)}")
+        return index
+
+    def _read_las_header(self, laz_file, feedback):
+        """Lee bbox, número de puntos y SRC (WKT) de la cabecera, sin descomprimir los puntos."""
+        if laspy is not None:
+            # LasHeader.read_from no necesita backend LAZ (lazrs/laszip), a diferencia de laspy.open
+            try:
+                with open(laz_file, 'rb') as f:
+                    header = laspy.LasHeader.read_from(f)
+                try:
+                    # parse_crs necesita pyproj; sin él el SRC queda sin determinar
+                    wkt = header.parse_crs().to_wkt()
+                except Exception:
+                    wkt = None
+                return {
+                    'bounds': [float(header.mins[0]), float(header.mins[1]),
+                               float(header.maxs[0]), float(header.maxs[1])],
+                    'count': int(header.point_count),
+                    'wkt': wkt
+                }
+            except Exception:
+                pass  # Se intenta con pdal info
 
-    def _create_merge_pipeline(self, input_files, output_file):
+        try:
+            startupinfo = None
+            if hasattr(subprocess, 'STARTUPINFO'):
+                startupinfo = subprocess.STARTUPINFO()
+                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+                startupinfo.wShowWindow = subprocess.SW_HIDE
+
+            result = subprocess.run(
+                ["pdal", "info", "--metadata", str(laz_file)],
+                check=True,
+                capture_output=True,
+                text=True,
+                timeout=60,
+                startupinfo=startupinfo,
+                creationflags=CREATE_NO_WINDOW
+            )
+            metadata = json.loads(result.stdout)['metadata']
+            return {
+                'bounds': [metadata['minx'], metadata['miny'], metadata['maxx'], metadata['maxy']],
+                'count': metadata['count'],
+                'wkt': metadata.get('srs', {}).get('wkt') or None
+            }
+        except Exception as e:
+            # Sin cabecera el archivo se procesa igualmente
+            feedback.pushInfo(f"No se pudo leer la cabecera de {laz_file.name}: {str(e)}")
+            return None
+
+    def _aoi_in_tiles_crs(self, parameters, context, tile_index, feedback):
+        """Devuelve el área de interés (xmin, ymin, xmax, ymax) en el SRC de los tiles, o None."""
+        aoi_crs = self.parameterAsExtentCrs(parameters, self.AOI, context)
+        wkt = next((e['wkt'] for e in tile_index.values() if e.get('wkt')), None)
+        tiles_crs = QgsCoordinateReferenceSystem.fromWkt(wkt) if wkt else QgsCoordinateReferenceSystem()
+        if tiles_crs.isValid():
+            # Con un SRC de destino parameterAsExtent reproyecta el área
+            extent = self.parameterAsExtent(parameters, self.AOI, context, tiles_crs)
+            if aoi_crs.isValid() and aoi_crs != tiles_crs:
+                feedback.pushInfo(
+                    f"Área de interés reproyectada de {aoi_crs.authid()} al SRC de los tiles "
+                    f"({tiles_crs.authid() or tiles_crs.description()})"
+                )
+        else:
+            extent = self.parameterAsExtent(parameters, self.AOI, context)
+            feedback.reportError(
+                "No se pudo leer el SRC de los tiles: el área de interés se usa sin reproyectar "
+                f"({aoi_crs.authid() or 'SRC desconocido'}); comprueba que coincide con la nube de puntos"
+            )
+        if extent.isNull():
+            return None
+        return (extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum())
+
+    def _bounds_intersect(self, a, b):
+        return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+    def _raster_output(self, output_folder, laz_file):
+        return output_folder / f"{laz_file.stem.removesuffix('.copc')}_raster.tif"
+
+    def _process_tile_batch(self, batch, output_folder, resolution, aoi, tile_bounds, feedback):
+        """Rasteriza varios archivos con un único pipeline PDAL. Devuelve [(archivo, raster o None)]."""
+        if len(batch) > 1 and not feedback.isCanceled():
+            feedback.pushInfo(f"Procesando lote: {', '.join(f.name for f in batch)}")
+            tiles = [(laz_file, self._raster_output(output_folder, laz_file)) for laz_file in batch]
+            pipeline = self._create_batch_pipeline(
+                [(str(laz_file), str(raster), tile_bounds.get(laz_file)) for laz_file, raster in tiles],
+                resolution, aoi
+            )
+            try:
+                # El límite de la CLI es por tile: un lote dispone del de todos sus archivos
+                if self._run_pdal_pipeline(pipeline, feedback, timeout=300 * len(batch)):
+                    return tiles
+            except Exception as e:
+                feedback.reportError(f"Error en el lote: {str(e)}")
+            # Un archivo defectuoso no debe invalidar el resto del lote
+            feedback.pushInfo("El lote falló; reintentando archivo por archivo")
+
+        return [
+            (laz_file, self._process_one_tile(
+                laz_file, output_folder, resolution, aoi, tile_bounds.get(laz_file), feedback
+            ))
+            for laz_file in batch
+        ]
+
+    def _process_one_tile(self, laz_file, output_folder, resolution, aoi, bounds, feedback):
+        """Filtra y rasteriza un archivo en un solo pipeline. Devuelve el raster o None."""
+        if feedback.isCanceled():
+            return None
+
+        feedback.pushInfo(f"Procesando: {laz_file.name}")
+
+        raster_output = self._raster_output(output_folder, laz_file)
+        pipeline = self._create_combined_pipeline(str(laz_file), str(raster_output), resolution, aoi, bounds)
+        if not self._run_pdal_pipeline(pipeline, feedback):
+            return None
+        return raster_output
+
+    # Los constructores de pipelines reciben rutas ya convertidas a str (una vez por archivo)
+    def _create_reader_stages(self, input_file, aoi):
+        # Lector explícito que ignora el VLR de extra bytes (LASF_Spec/4): PDAL no crea
+        # esas dimensiones. nosrs no se usa porque el raster de salida perdería el SRC
+        reader = {"type": "readers.las", "filename": input_file, "ignore_vlr": "LASF_Spec/4"}
+        if aoi is None:
+            return [reader]
+        xmin, ymin, xmax, ymax = aoi
+        bounds = f"([{xmin}, {xmax}], [{ymin}, {ymax}])"
+        # COPC permite consultar sólo los nodos que tocan el área, sin decodificar el tile entero
+        if input_file.lower().endswith('.copc.laz'):
+            return [{"type": "readers.copc", "filename": input_file, "bounds": bounds}]
+        return [reader, {"type": "filters.crop", "bounds": bounds}]
+
+    def _raster_grid(self, bounds, resolution, aoi=None):
+        """Opciones de writers.gdal para una malla común a todos los tiles ({} sin bbox)."""
+        # Sin origen explícito PDAL lo toma del mínimo de cada tile y las mallas quedan
+        # desplazadas fracciones de píxel; con el origen múltiplo de la resolución el
+        # VRT une los rasters sin remuestrear
+        if bounds is None:
+            return {}
+        xmin, ymin, xmax, ymax = bounds
+        if aoi is not None:
+            xmin, ymin = max(xmin, aoi[0]), max(ymin, aoi[1])
+            xmax, ymax = min(xmax, aoi[2]), min(ymax, aoi[3])
+        origin_x = math.floor(xmin / resolution) * resolution
+        origin_y = math.floor(ymin / resolution) * resolution
         return {
-            "pipeline": [
-                *[str(f) for f in input_files],
-                {"type": "filters.merge"},
-                str(output_file)
-            ]
+            "origin_x": origin_x,
+            "origin_y": origin_y,
+            "width": math.floor((xmax - origin_x) / resolution) + 1,
+            "height": math.floor((ymax - origin_y) / resolution) + 1
         }
 
-    def _create_raster_pipeline(self, input_file, output_file, resolution):
+    def _create_combined_pipeline(self, input_file, output_file, resolution, aoi=None, bounds=None,
+                                  classifications=CLASSIFICATIONS):
+        # Todas las clases en un único filters.range (rangos separados por coma = OR):
+        # el LAZ se decodifica una sola vez y no hay archivos LAS intermedios
+        limits = ",".join(f"Classification[{c}:{c}]" for c in classifications)
         return {
             "pipeline": [
-                str(input_file),
+                *self._create_reader_stages(input_file, aoi),
+                {"type": "filters.range", "limits": limits},
                 {
                     "type": "writers.gdal",
-                    "filename": str(output_file),
+                    "filename": output_file,
                     "resolution": resolution,
+                    "dimension": "Z",  # Valor por defecto; explícito por claridad
                     "output_type": "max",
-                    "gdalopts": "COMPRESS=DEFLATE,TILED=YES"
+                    "data_type": "float32",
+                    "nodata": RASTER_NODATA,
+                    # Interpola huecos pequeños al rasterizar: menos trabajo para fillnodata
+                    "window_size": 3,
+                    "gdalopts": RASTER_GDALOPTS,
+                    **self._raster_grid(bounds, resolution, aoi)
                 }
             ]
         }
 
-    def _run_pdal_pipeline(self, pipeline, pipeline_file, feedback):
-        with open(pipeline_file, 'w') as f:
-            json.dump(pipeline, f, indent=2)
-        cmd = ["pdal", "pipeline", str(pipeline_file)]
-        return self._run_command(cmd, feedback)
-
-    def _run_command(self, cmd, feedback):
+    def _create_batch_pipeline(self, tiles, resolution, aoi=None):
+        # Cadenas lector → filtro → writer independientes, enlazadas por tags
+        stages = []
+        writers = []
+        for i, (input_file, output_file, bounds) in enumerate(tiles):
+            chain = self._create_combined_pipeline(input_file, output_file, resolution, aoi, bounds)["pipeline"]
+            for j, stage in enumerate(chain):
+                stage = dict(stage, tag=f"t{i}_{j}")
+                if j > 0:
+                    stage["inputs"] = [f"t{i}_{j - 1}"]
+                stages.append(stage)
+            writers.append(f"t{i}_{len(chain) - 1}")
+        # Un único nodo final para que PDAL ejecute todos los writers del lote
+        stages.append({"type": "filters.merge", "inputs": writers})
+        return {"pipeline": stages}
+
+    def _build_vrt(self, raster_outputs, output_folder, feedback):
+        if gdal is None:
+            return None
+        vrt_file = output_folder / 'dsm.vrt'
+        # Los tiles comparten malla (_raster_grid), así que el VRT sólo yuxtapone bloques;
+        # nearest sólo actúa si algún tile se rasterizó sin bbox en el índice
+        options = gdal.BuildVRTOptions(
+            resampleAlg='nearest', srcNodata=RASTER_NODATA, VRTNodata=RASTER_NODATA
+        )
         try:
-            startupinfo = None
-            if hasattr(subprocess, 'STARTUPINFO'):
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                startupinfo.wShowWindow = subprocess.SW_HIDE
-            
-            result = subprocess.run(
-                cmd, 
-                check=True, 
-                capture_output=True, 
-                text=True, 
-                timeout=300,
-                startupinfo=startupinfo
-            )
-            return True
-        except subprocess.CalledProcessError as e:
-            feedback.reportError(f"Error: {e.stderr.strip() if e.stderr else 'Sin detalles'}")
+            vrt = gdal.BuildVRT(str(vrt_file), [str(r) for r in raster_outputs], options=options)
+        except RuntimeError:
+            vrt = None
+        if vrt is None:
+            feedback.reportError("No se pudo construir el mosaico VRT; se rellenará cada raster por separado")
+            return None
+        # Cerrar el dataset escribe el VRT a disco
+        vrt = None
+        return vrt_file
+
+    def _fill_nodata(self, raster_file, output_file, fill_distance, fillnodata_cmd, workers, feedback):
+        if feedback.isCanceled():
             return False
-        except subprocess.TimeoutExpired:
-            feedback.reportError("Timeout: comando excedió los 5 minutos")
+
+        if fillnodata_cmd is not None:
+            cmd = [
+                *fillnodata_cmd,
+                "-md", str(fill_distance),
+                "-si", "0",
+                str(raster_file),
+                str(output_file)
+            ]
+            env = dict(os.environ, GDAL_CACHEMAX=str(GDAL_CACHEMAX_MB))
+            # Sin límite de tiempo: sobre el mosaico VRT completo puede tardar mucho más
+            # que un tile; la cancelación se sigue comprobando mientras corre
+            return self._run_command(cmd, feedback, timeout=None, env=env)
+
+        try:
+            return self._fill_nodata_windowed(raster_file, output_file, fill_distance, workers, feedback)
+        except rasterio.errors.RasterioError as e:
+            feedback.reportError(f"Error rellenando {raster_file.name}: {str(e)}")
             return False
 
-    def _detect_fillnodata(self):
-        opciones = [
-            ["python", "-m", "osgeo_utils.gdal_fillnodata"],
-            ["gdal_fillnodata"],
-            ["gdal_fillnodata.py"]
-        ]
-        for cmd in opciones:
+    def _fill_nodata_windowed(self, raster_file, output_file, fill_distance, workers, feedback):
+        """Rellena por bloques con un margen de fill_distance píxeles, sin cargar el raster completo."""
+        halo = fill_distance
+
+        # El intermedio sin comprimir (el mosaico completo, puede ocupar varios GB) va
+        # junto a la salida y no al temporal del sistema, que puede ser tmpfs o un disco
+        # pequeño; además la copia final comprimida no cruza de sistema de archivos
+        with tempfile.TemporaryDirectory(prefix="lidarwf_", dir=output_file.parent) as tmp_dir:
+            tmp_output = Path(tmp_dir) / output_file.name
+            with rasterio.Env(GDAL_CACHEMAX=GDAL_CACHEMAX_MB):
+                with rasterio.open(raster_file) as src:
+                    # Salida temporal sin compresión; se comprime una sola vez al final
+                    profile = src.profile.copy()
+                    profile.pop('compress', None)
+                    profile.update(driver='GTiff', tiled=True, blockxsize=512, blockysize=512)
+
+                    with rasterio.open(tmp_output, 'w', **profile) as dst:
+                        windows = [window for _, window in dst.block_windows(1)]
+                        with ThreadPoolExecutor(max_workers=workers) as executor:
+                            # Lectura/escritura en este hilo (los datasets no son thread-safe);
+                            # fillnodata libera el GIL y corre en paralelo sobre cada lote
+                            for i in range(0, len(windows), workers):
+                                if feedback.isCanceled():
+                                    return False
+                                tiles = [self._read_with_halo(src, w, halo) for w in windows[i:i + workers]]
+                                for inner, data in executor.map(lambda t: self._fill_tile(t, fill_distance), tiles):
+                                    dst.write(data, 1, window=inner)
+
+                rasterio.shutil.copy(tmp_output, output_file, driver='GTiff', compress='DEFLATE', predictor=3, tiled=True)
+        return True
+
+    def _read_with_halo(self, src, inner, halo):
+        row0 = max(inner.row_off - halo, 0)
+        col0 = max(inner.col_off - halo, 0)
+        row1 = min(inner.row_off + inner.height + halo, src.height)
+        col1 = min(inner.col_off + inner.width + halo, src.width)
+        outer = Window(col0, row0, col1 - col0, row1 - row0)
+        return inner, outer, src.read(1, window=outer), src.read_masks(1, window=outer)
+
+    def _fill_tile(self, tile, fill_distance):
+        inner, outer, data, mask = tile
+        if not mask.all():
+            data = fillnodata(data, mask=mask, max_search_distance=fill_distance, smoothing_iterations=0)
+        r = inner.row_off - outer.row_off
+        c = inner.col_off - outer.col_off
+        return inner, data[r:r + inner.height, c:c + inner.width]
+
+    def _run_pdal_pipeline(self, pipeline, feedback, timeout=300):
+        # Con los bindings de Python el pipeline se ejecuta en el mismo proceso
+        if pdal is not None:
             try:
-                startupinfo = None
-                if hasattr(subprocess, 'STARTUPINFO'):
-                    startupinfo = subprocess.STARTUPINFO()
-                    startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-                    startupinfo.wShowWindow = subprocess.SW_HIDE
-                
-                subprocess.run(
-                    cmd + ["--help"], 
-                    check=True, 
-                    capture_output=True, 
-                    timeout=5,
-                    startupinfo=startupinfo
-                )
-                return cmd
-            except:
-                continue
-        return None
+                pdal.Pipeline(_pipeline_json(pipeline).decode()).execute()
+                return True
+            except RuntimeError as e:
+                feedback.reportError(f"Error: {str(e)}")
+                return False
+
+        # Sin bindings: CLI de PDAL leyendo el pipeline por stdin, sin tocar disco
+        return self._run_command(
+            ["pdal", "pipeline", "--stdin"], feedback, timeout=timeout, input=_pipeline_json(pipeline)
+        )
+
+    def _run_command(self, cmd, feedback, timeout=300, env=None, input=None):
+        startupinfo = None
+        if hasattr(subprocess, 'STARTUPINFO'):
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            startupinfo.wShowWindow = subprocess.SW_HIDE
+
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE if input is not None else None,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                env=env,
+                startupinfo=startupinfo,
+                creationflags=CREATE_NO_WINDOW
+            )
+        except OSError as e:
+            feedback.reportError(f"No se pudo ejecutar {cmd[0]}: {str(e)}")
+            return False
+        # Esperar en intervalos cortos para poder terminar el proceso si se cancela;
+        # communicate() va vaciando stderr para que el pipe nunca se llene
+        # timeout=None: sin límite, sólo se termina si se cancela
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            try:
+                _, stderr = proc.communicate(input, timeout=0.5)
+                break
+            except subprocess.TimeoutExpired:
+                # El input ya se envió; los reintentos no pueden volver a pasarlo
+                input = None
+                if feedback.isCanceled():
+                    proc.kill()
+                    proc.communicate()
+                    return False
+                if deadline is not None and time.monotonic() > deadline:
+                    proc.kill()
+                    proc.communicate()
+                    feedback.reportError(f"Timeout: comando excedió los {timeout} segundos")
+                    return False
+
+        if proc.returncode != 0:
+            detalle = stderr.decode('utf-8', 'replace').strip() if stderr else ''
+            feedback.reportError(f"Error: {detalle or 'Sin detalles'}")
+            return False
+        return True
 
 
 def classFactory(iface=None):
@@ -1,218 +1,545 @@
 """
 Workflow de procesamiento LIDAR
-- Filtrado de puntos (suelo y edificios)
-- Fusión de clasificaciones
-- Creación de DTM + edificaciones
-- Relleno de datos faltantes
+- Filtrado de puntos (suelo y edificios) y creación de DTM + edificaciones
+  en un único pipeline PDAL por archivo
+- Mosaico VRT y relleno de datos faltantes
 """
 
 import os
 import json
+import functools
+import math
+import shutil
 import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    import pdal
+except ImportError:
+    pdal = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+try:
+    import laspy
+except ImportError:
+    laspy = None
+
+try:
+    import rasterio
+    import rasterio.shutil
+    from rasterio.fill import fillnodata
+    from rasterio.windows import Window
+except ImportError:
+    rasterio = None
+
 # CONFIGURACIÓN RUTAS
 INPUT_FOLDER = Path("C:/Users/lucas/Downloads/toledo3")
 OUTPUT_FOLDER = Path("C:/Users/lucas/Downloads/toledo3/resultados")
 NODATA_FOLDER = Path("C:/Users/lucas/Downloads/toledo3/resultados/nodata_rasters")
-TEMP_FOLDER = Path("C:/Users/lucas/Downloads/toledo3/temp")
-
-# Crear carpetas
-OUTPUT_FOLDER.mkdir(parents=True, exist_ok=True)
-NODATA_FOLDER.mkdir(parents=True, exist_ok=True)
-TEMP_FOLDER.mkdir(parents=True, exist_ok=True)
 
 # CONFIGURACIÓN PROCESAMIENTO
 RESOLUTION = 0.5  # Resolución del raster en metros
 FILL_DISTANCE = 75  # Distancia para rellenar NoData
-
-# LISTA DE ARCHIVOS
-laz_files = list(INPUT_FOLDER.glob("*.laz"))
-print(f"📦 Encontrados {len(laz_files)} archivos LAZ para procesar\n")
-
-if not laz_files:
-    print("⚠️  No se encontraron archivos .laz en la carpeta de entrada")
-    exit()
+CLASSIFICATIONS = (2, 6)  # Clases ASPRS rasterizadas: suelo (2) y edificios (6)
+RASTER_NODATA = -9999  # NoData del raster de PDAL
+# float32 sobra para alturas LiDAR; PREDICTOR=3 mejora DEFLATE en flotantes.
+# Sin NUM_THREADS: ya se ejecuta un writer por núcleo en paralelo
+RASTER_GDALOPTS = "COMPRESS=DEFLATE,TILED=YES,PREDICTOR=3,BLOCKXSIZE=512,BLOCKYSIZE=512"
+# Máximo de tiles por pipeline de la CLI de PDAL (reparte el arranque de cada proceso
+# pdal; el lote completo queda en memoria). Con los bindings no se agrupan tiles
+TILE_BATCH_SIZE = max(1, (os.cpu_count() or 1) // 2)
+GDAL_CACHEMAX_MB = 512  # Caché de bloques de GDAL durante el relleno de NoData
+TILE_INDEX_FILE = OUTPUT_FOLDER / "_lazindex.json"  # Índice de cabeceras (bbox + nº de puntos)
+AOI = None  # Área de interés (xmin, ymin, xmax, ymax) en el SRC de la nube; None = tiles completos
 
 # FUNCIONES AUXILIARES
-def run_command(cmd, description):
+def run_command(cmd, description, env=None, input=None):
     """Ejecuta un comando y maneja errores"""
+    # stdout se descarta y stderr sólo se decodifica si el comando falla
     try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        return True
-    except subprocess.CalledProcessError as e:
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE if input is not None else None,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            env=env
+        )
+    except OSError as e:
         print(f"    ❌ Error en {description}")
-        if e.stderr:
-            print(f"    {e.stderr.strip()}")
+        print(f"    No se pudo ejecutar {cmd[0]}: {e}")
         return False
+    _, stderr = proc.communicate(input)
+    if proc.returncode != 0:
+        print(f"    ❌ Error en {description}")
+        if stderr:
+            print(f"    {stderr.decode('utf-8', 'replace').strip()}")
+        return False
+    return True
 
-def create_pipeline_json(input_file, output_file, classification):
-    """Crea un pipeline JSON de PDAL para filtrar por clasificación"""
-    pipeline = {
-        "pipeline": [
-            str(input_file),
-            {
-                "type": "filters.range",
-                "limits": f"Classification[{classification}:{classification}]"
-            },
-            str(output_file)
-        ]
+def bounds_intersect(a, b):
+    """Indica si dos bbox (xmin, ymin, xmax, ymax) se solapan"""
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def create_reader_stages(input_file, aoi):
+    """Crea las etapas de lectura de PDAL, limitadas al área de interés si se indica"""
+    # Los constructores de pipelines reciben rutas str, convertidas una vez por archivo
+    # Lector explícito que ignora el VLR de extra bytes (LASF_Spec/4): PDAL no crea
+    # esas dimensiones. nosrs no se usa porque el raster de salida perdería el SRC
+    reader = {"type": "readers.las", "filename": input_file, "ignore_vlr": "LASF_Spec/4"}
+    if aoi is None:
+        return [reader]
+    xmin, ymin, xmax, ymax = aoi
+    bounds = f"([{xmin}, {xmax}], [{ymin}, {ymax}])"
+    # COPC permite consultar sólo los nodos que tocan el área, sin decodificar el tile entero
+    if input_file.lower().endswith(".copc.laz"):
+        return [{"type": "readers.copc", "filename": input_file, "bounds": bounds}]
+    return [reader, {"type": "filters.crop", "bounds": bounds}]
+
+def raster_output_path(output_folder, laz_file):
+    """Ruta del raster DTM+edificaciones de un archivo LAZ/LAS"""
+    return output_folder / f"{laz_file.stem.removesuffix('.copc')}_raster.tif"
+
+def raster_grid(bounds, resolution, aoi=None):
+    """Opciones de writers.gdal para una malla común a todos los tiles (o {} sin bbox)"""
+    # Sin origen explícito PDAL lo toma del mínimo de cada tile y las mallas quedan
+    # desplazadas fracciones de píxel; con el origen múltiplo de la resolución el VRT
+    # une los rasters sin remuestrear
+    if bounds is None:
+        return {}
+    xmin, ymin, xmax, ymax = bounds
+    if aoi is not None:
+        xmin, ymin = max(xmin, aoi[0]), max(ymin, aoi[1])
+        xmax, ymax = min(xmax, aoi[2]), min(ymax, aoi[3])
+    origin_x = math.floor(xmin / resolution) * resolution
+    origin_y = math.floor(ymin / resolution) * resolution
+    return {
+        "origin_x": origin_x,
+        "origin_y": origin_y,
+        "width": math.floor((xmax - origin_x) / resolution) + 1,
+        "height": math.floor((ymax - origin_y) / resolution) + 1
     }
-    return pipeline
 
-def create_merge_pipeline_json(input_files, output_file):
-    """Crea un pipeline JSON de PDAL para fusionar archivos"""
+def create_combined_pipeline_json(input_file, output_file, resolution, aoi=None, bounds=None,
+                                  classifications=CLASSIFICATIONS):
+    """Crea un pipeline JSON de PDAL que filtra suelo + edificios y genera el raster"""
+    # Un único filters.range para todas las clases (rangos separados por coma = OR):
+    # el LAZ se decodifica una sola vez y no se escriben archivos LAS intermedios
+    limits = ",".join(f"Classification[{c}:{c}]" for c in classifications)
     pipeline = {
         "pipeline": [
-            *[str(f) for f in input_files],
+            *create_reader_stages(input_file, aoi),
             {
-                "type": "filters.merge"
+                "type": "filters.range",
+                "limits": limits
             },
-            str(output_file)
-        ]
-    }
-    return pipeline
-
-def create_raster_pipeline_json(input_file, output_file, resolution):
-    """Crea un pipeline JSON de PDAL para generar raster"""
-    pipeline = {
-        "pipeline": [
-            str(input_file),
             {
                 "type": "writers.gdal",
-                "filename": str(output_file),
+                "filename": output_file,
                 "resolution": resolution,
+                "dimension": "Z",  # Valor por defecto; explícito por claridad
                 "output_type": "max",
-                "gdalopts": "COMPRESS=DEFLATE,TILED=YES"
+                "data_type": "float32",
+                "nodata": RASTER_NODATA,
+                # Interpola huecos pequeños al rasterizar: menos trabajo para fillnodata
+                "window_size": 3,
+                "gdalopts": RASTER_GDALOPTS,
+                **raster_grid(bounds, resolution, aoi)
             }
         ]
     }
     return pipeline
 
-def run_pdal_pipeline(pipeline, pipeline_file, description):
+def create_batch_pipeline_json(tiles, resolution, aoi=None):
+    """Crea un único pipeline JSON de PDAL para varias ternas (archivo, raster, bbox)"""
+    # Cadenas lector → filtro → writer independientes, enlazadas por tags
+    stages = []
+    writers = []
+    for i, (input_file, output_file, bounds) in enumerate(tiles):
+        chain = create_combined_pipeline_json(input_file, output_file, resolution, aoi, bounds)["pipeline"]
+        for j, stage in enumerate(chain):
+            stage = dict(stage, tag=f"t{i}_{j}")
+            if j > 0:
+                stage["inputs"] = [f"t{i}_{j - 1}"]
+            stages.append(stage)
+        writers.append(f"t{i}_{len(chain) - 1}")
+    # Un único nodo final para que PDAL ejecute todos los writers del lote
+    stages.append({"type": "filters.merge", "inputs": writers})
+    return {"pipeline": stages}
+
+def pipeline_json(pipeline):
+    """Serializa un pipeline de PDAL a bytes JSON compactos (con orjson si está instalado)"""
+    if orjson is not None:
+        return orjson.dumps(pipeline)
+    return json.dumps(pipeline, separators=(",", ":")).encode()
+
+def run_pdal_pipeline(pipeline, description):
     """Ejecuta un pipeline de PDAL"""
-    # Escribir el pipeline a un archivo JSON temporal
-    with open(pipeline_file, 'w') as f:
-        json.dump(pipeline, f, indent=2)
+    # Con los bindings de Python el pipeline se ejecuta en el mismo proceso
+    if pdal is not None:
+        try:
+            pdal.Pipeline(pipeline_json(pipeline).decode()).execute()
+            return True
+        except RuntimeError as e:
+            print(f"    ❌ Error en {description}")
+            print(f"    {e}")
+            return False
     
-    # Ejecutar PDAL con el pipeline
-    cmd = ["pdal", "pipeline", str(pipeline_file)]
-    return run_command(cmd, description)
-
-# PROCESAMIENTO
-raster_outputs = []
+    # Sin bindings: CLI de PDAL leyendo el pipeline por stdin, sin tocar disco
+    cmd = ["pdal", "pipeline", "--stdin"]
+    return run_command(cmd, description, input=pipeline_json(pipeline))
 
-for i, laz_file in enumerate(laz_files, 1):
-    print(f"{'='*70}")
-    print(f"🔄 [{i}/{len(laz_files)}] Procesando: {laz_file.name}")
-    print(f"{'='*70}")
+def read_las_header(laz_file):
+    """Lee bbox y número de puntos de la cabecera LAS, sin descomprimir los puntos"""
+    if laspy is not None:
+        # LasHeader.read_from no necesita backend LAZ (lazrs/laszip), a diferencia de laspy.open
+        try:
+            with open(laz_file, "rb") as f:
+                header = laspy.LasHeader.read_from(f)
+            return {
+                "bounds": [float(header.mins[0]), float(header.mins[1]),
+                           float(header.maxs[0]), float(header.maxs[1])],
+                "count": int(header.point_count)
+            }
+        except Exception:
+            pass  # Se intenta con pdal info
     
-    base_name = laz_file.stem
+    try:
+        result = subprocess.run(
+            ["pdal", "info", "--metadata", str(laz_file)],
+            check=True, capture_output=True, text=True, timeout=60
+        )
+        metadata = json.loads(result.stdout)["metadata"]
+        return {
+            "bounds": [metadata["minx"], metadata["miny"], metadata["maxx"], metadata["maxy"]],
+            "count": metadata["count"]
+        }
+    except Exception as e:
+        # Sin cabecera el archivo se procesa igualmente
+        print(f"  ⚠️  No se pudo leer la cabecera de {laz_file.name}: {e}")
+        return None
+
+def load_tile_index(laz_files, index_file):
+    """Devuelve {ruta: {bounds, count, size, mtime}}; sólo relee las cabeceras que cambiaron"""
+    try:
+        with open(index_file) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = {}
     
-    # Archivos intermedios
-    output_suelo = OUTPUT_FOLDER / f"{base_name}_suelo.las"
-    output_edificios = OUTPUT_FOLDER / f"{base_name}_edificios.las"
-    output_merged = OUTPUT_FOLDER / f"{base_name}_merged.las"
-    raster_output = OUTPUT_FOLDER / f"{base_name}_raster.tif"
+    index = {}
+    for laz_file in laz_files:
+        key = str(laz_file)
+        stat = laz_file.stat()
+        entry = cached.get(key)
+        if entry is None or entry.get("size") != stat.st_size or entry.get("mtime") != stat.st_mtime_ns:
+            header = read_las_header(laz_file)
+            if header is None:
+                continue
+            entry = dict(header, size=stat.st_size, mtime=stat.st_mtime_ns)
+        index[key] = entry
     
-    # Archivos de pipeline temporales
-    pipeline_suelo = TEMP_FOLDER / f"pipeline_suelo_{base_name}.json"
-    pipeline_edificios = TEMP_FOLDER / f"pipeline_edificios_{base_name}.json"
-    pipeline_merge = TEMP_FOLDER / f"pipeline_merge_{base_name}.json"
-    pipeline_raster = TEMP_FOLDER / f"pipeline_raster_{base_name}.json"
+    try:
+        with open(index_file, "w") as f:
+            json.dump(index, f)
+    except OSError as e:
+        print(f"  ⚠️  No se pudo guardar {index_file.name}: {e}")
+    return index
+
+def process_one_tile(laz_file, output_folder, resolution, aoi=None, bounds=None):
+    """Filtra y rasteriza un archivo LAZ/LAS en un solo pipeline y devuelve el raster o None"""
+    raster_output = raster_output_path(output_folder, laz_file)
     
     try:
-        # --- 1. FILTRADO: SUELO (Clasificación 2) ---
-        print("  🌍 Filtrando puntos de suelo (Clase 2)...")
-        pipeline = create_pipeline_json(laz_file, output_suelo, 2)
-        if not run_pdal_pipeline(pipeline, pipeline_suelo, "filtrado de suelo"):
-            continue
-        
-        # --- 2. FILTRADO: EDIFICIOS (Clasificación 6) ---
-        print("  🏢 Filtrando puntos de edificios (Clase 6)...")
-        pipeline = create_pipeline_json(laz_file, output_edificios, 6)
-        if not run_pdal_pipeline(pipeline, pipeline_edificios, "filtrado de edificios"):
-            continue
+        # --- FILTRADO (Clases 2 y 6) + EXPORTAR A RASTER (DTM+edificaciones) ---
+        print(f"  📊 [{laz_file.name}] Filtrando suelo + edificios y generando raster...")
+        pipeline = create_combined_pipeline_json(str(laz_file), str(raster_output), resolution, aoi, bounds)
+        if not run_pdal_pipeline(pipeline, "filtrado y generación de raster"):
+            return None
         
-        # --- 3. FUSIÓN DE CLASIFICACIONES ---
-        print("  🔗 Fusionando suelo + edificios...")
-        pipeline = create_merge_pipeline_json([output_suelo, output_edificios], output_merged)
-        if not run_pdal_pipeline(pipeline, pipeline_merge, "fusión"):
-            continue
-        
-        # --- 4. EXPORTAR A RASTER (DTM+edificaciones) ---
-        print("  📊 Generando raster DTM+edificaciones...")
-        pipeline = create_raster_pipeline_json(output_merged, raster_output, RESOLUTION)
-        if not run_pdal_pipeline(pipeline, pipeline_raster, "generación de raster"):
-            continue
-        
-        raster_outputs.append(raster_output)
-        print(f"✅ Completado: {laz_file.name}\n")
+        return raster_output
         
     except Exception as e:
         print(f"❌ Error procesando {laz_file.name}: {e}\n")
-        continue
+        return None
+
+def process_tile_batch(batch, output_folder, resolution, aoi=None, tile_bounds=None):
+    """Rasteriza varios archivos con un único pipeline y devuelve [(archivo, raster o None)]"""
+    tile_bounds = tile_bounds or {}
+    if len(batch) > 1:
+        print(f"  📊 Lote de {len(batch)} archivos: {', '.join(f.name for f in batch)}")
+        tiles = [(laz_file, raster_output_path(output_folder, laz_file)) for laz_file in batch]
+        pipeline = create_batch_pipeline_json(
+            [(str(laz_file), str(raster), tile_bounds.get(laz_file)) for laz_file, raster in tiles],
+            resolution, aoi
+        )
+        try:
+            if run_pdal_pipeline(pipeline, "rasterización por lote"):
+                return tiles
+        except Exception as e:
+            print(f"    ❌ Error en rasterización por lote: {e}")
+        # Un archivo defectuoso no debe invalidar el resto del lote
+        print("  ⚠️  El lote falló; reintentando archivo por archivo")
+    
+    return [
+        (laz_file, process_one_tile(laz_file, output_folder, resolution, aoi, tile_bounds.get(laz_file)))
+        for laz_file in batch
+    ]
 
 # DETECTAR COMANDO GDAL_FILLNODATA
+@functools.lru_cache(maxsize=1)
 def get_fillnodata_command():
-    """Detecta cómo ejecutar gdal_fillnodata en el sistema"""
-    # Probar diferentes opciones
-    opciones = [
-        ["python", "-m", "osgeo_utils.gdal_fillnodata"],  # Conda/pip
-        ["gdal_fillnodata"],  # Comando directo
-        ["gdal_fillnodata.py"],  # Script directo
-    ]
-    
-    for cmd in opciones:
-        try:
-            test_cmd = cmd + ["--help"]
-            subprocess.run(test_cmd, check=True, capture_output=True, timeout=5)
-            return cmd
-        except:
+    """Detecta cómo ejecutar gdal_fillnodata en el sistema (una sola vez)"""
+    # Ejecutables en el PATH: basta con shutil.which, sin lanzar procesos.
+    # Se devuelve la ruta resuelta; en Windows which también encuentra .py/.bat
+    # (vía PATHEXT) que no se pueden lanzar sin shell
+    for exe in ("gdal_fillnodata", "gdal_fillnodata.py"):
+        path = shutil.which(exe)
+        if path is None:
+            continue
+        if path.lower().endswith(".py"):
+            return (sys.executable, path)
+        if os.name == "nt" and path.lower().endswith((".bat", ".cmd")):
             continue
+        return (path,)
     
-    return None
+    # Conda/pip: hay que comprobar que el módulo existe
+    cmd = ("python", "-m", "osgeo_utils.gdal_fillnodata")
+    try:
+        subprocess.run([*cmd, "--help"], check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, timeout=5)
+        return cmd
+    except (OSError, subprocess.SubprocessError):
+        return None
 
-# RELLENO DE DATOS FALTANTES
-if raster_outputs:
-    print(f"\n{'='*70}")
-    print(f"🔧 Iniciando relleno de datos faltantes (fillnodata)")
-    print(f"{'='*70}\n")
-    
-    fillnodata_cmd = get_fillnodata_command()
+def read_with_halo(src, inner, halo):
+    """Lee una ventana ampliada en halo píxeles (recortada a los límites del raster)"""
+    row0 = max(inner.row_off - halo, 0)
+    col0 = max(inner.col_off - halo, 0)
+    row1 = min(inner.row_off + inner.height + halo, src.height)
+    col1 = min(inner.col_off + inner.width + halo, src.width)
+    outer = Window(col0, row0, col1 - col0, row1 - row0)
+    return inner, outer, src.read(1, window=outer), src.read_masks(1, window=outer)
+
+def fill_tile(tile, fill_distance):
+    """Rellena NoData de una ventana ampliada y devuelve sólo la ventana interior"""
+    inner, outer, data, mask = tile
+    # mask == 0 indica los píxeles a rellenar
+    if not mask.all():
+        data = fillnodata(data, mask=mask, max_search_distance=fill_distance, smoothing_iterations=0)
+    r = inner.row_off - outer.row_off
+    c = inner.col_off - outer.col_off
+    return inner, data[r:r + inner.height, c:c + inner.width]
+
+def fill_nodata_raster(raster_file, output_file, fill_distance, workers=None):
+    """Rellena NoData de un raster en el mismo proceso con rasterio, por bloques"""
+    try:
+        # El intermedio sin comprimir (el mosaico completo, puede ocupar varios GB) va
+        # junto a la salida y no al temporal del sistema, que puede ser tmpfs o un disco
+        # pequeño; además la copia final comprimida no cruza de sistema de archivos
+        with tempfile.TemporaryDirectory(prefix="lidarwf_", dir=output_file.parent) as tmp_dir:
+            tmp_output = Path(tmp_dir) / output_file.name
+            with rasterio.Env(GDAL_CACHEMAX=GDAL_CACHEMAX_MB):
+                with rasterio.open(raster_file) as src:
+                    # Salida temporal sin compresión; se comprime una sola vez al final
+                    profile = src.profile.copy()
+                    profile.pop('compress', None)
+                    profile.update(driver='GTiff', tiled=True, blockxsize=512, blockysize=512)
+                    
+                    with rasterio.open(tmp_output, 'w', **profile) as dst:
+                        windows = [window for _, window in dst.block_windows(1)]
+                        workers = workers or os.cpu_count() or 1
+                        with ThreadPoolExecutor(max_workers=workers) as executor:
+                            # Lectura/escritura en este hilo (los datasets no son thread-safe);
+                            # fillnodata libera el GIL y corre en paralelo sobre cada lote
+                            for i in range(0, len(windows), workers):
+                                tiles = [read_with_halo(src, w, fill_distance) for w in windows[i:i + workers]]
+                                for inner, data in executor.map(lambda t: fill_tile(t, fill_distance), tiles):
+                                    dst.write(data, 1, window=inner)
+                
+                rasterio.shutil.copy(tmp_output, output_file, driver='GTiff', compress='DEFLATE', predictor=3, tiled=True)
+        return True
+    except rasterio.errors.RasterioError as e:
+        print(f"    ❌ Error en relleno de NoData")
+        print(f"    {e}")
+        return False
+
+def build_vrt(raster_outputs, vrt_file):
+    """Une los rasters en un mosaico virtual (VRT) y devuelve su ruta, o None"""
+    if gdal is None:
+        return None
+    # Los tiles comparten malla (raster_grid), así que el VRT sólo yuxtapone bloques;
+    # nearest sólo actúa si algún tile se rasterizó sin bbox en el índice
+    options = gdal.BuildVRTOptions(
+        resampleAlg="nearest", srcNodata=RASTER_NODATA, VRTNodata=RASTER_NODATA
+    )
+    try:
+        vrt = gdal.BuildVRT(str(vrt_file), [str(r) for r in raster_outputs], options=options)
+    except RuntimeError:
+        vrt = None
+    if vrt is None:
+        print("⚠️  No se pudo construir el mosaico VRT; se rellenará cada raster por separado")
+        return None
+    # Cerrar el dataset escribe el VRT a disco
+    vrt = None
+    return vrt_file
+
+def fill_one(raster_file, nodata_folder, fill_distance, fillnodata_cmd, workers):
+    """Rellena NoData de un raster (función de módulo para poder usarla en ProcessPoolExecutor)"""
+    output_nodata = nodata_folder / f"{raster_file.stem}_nodata.tif"
     
     if fillnodata_cmd is None:
-        print("❌ No se pudo encontrar gdal_fillnodata en el sistema")
-        print("   Instala GDAL Python utilities: pip install gdal")
+        ok = fill_nodata_raster(raster_file, output_nodata, fill_distance, workers)
     else:
-        print(f"✓ Usando comando: {' '.join(fillnodata_cmd)}\n")
+        cmd_fillnodata = [
+            *fillnodata_cmd,
+            "-md", str(fill_distance),
+            "-si", "0",
+            str(raster_file),
+            str(output_nodata)
+        ]
+        env = dict(os.environ, GDAL_CACHEMAX=str(GDAL_CACHEMAX_MB))
+        ok = run_command(cmd_fillnodata, "relleno de NoData", env=env)
+    
+    return output_nodata if ok else None
+
+def main():
+    # Crear carpetas
+    OUTPUT_FOLDER.mkdir(parents=True, exist_ok=True)
+    NODATA_FOLDER.mkdir(parents=True, exist_ok=True)
+
+    # LISTA DE ARCHIVOS
+    # Una sola pasada por la carpeta; DirEntry ya trae la información de stat
+    laz_files = [
+        Path(e.path) for e in os.scandir(INPUT_FOLDER)
+        if e.is_file() and e.name.lower().endswith((".laz", ".las"))
+    ]
+    print(f"📦 Encontrados {len(laz_files)} archivos LAZ/LAS para procesar\n")
+
+    if not laz_files:
+        print("⚠️  No se encontraron archivos .laz/.las en la carpeta de entrada")
+        return
+
+    # Descartar tiles vacíos leyendo sólo las cabeceras, antes de lanzar PDAL
+    tile_index = load_tile_index(laz_files, TILE_INDEX_FILE)
+    pending = []
+    for laz_file in laz_files:
+        entry = tile_index.get(str(laz_file), {})
+        if entry.get("count") == 0:
+            continue
+        if AOI is not None and "bounds" in entry and not bounds_intersect(entry["bounds"], AOI):
+            continue
+        pending.append(laz_file)
+    if len(pending) < len(laz_files):
+        print(f"⏭️  Omitidos {len(laz_files) - len(pending)} archivos sin puntos o fuera del área de interés\n")
+    if AOI is not None and any(not f.name.lower().endswith(".copc.laz") for f in pending):
+        print("💡 Convierte los tiles a COPC una sola vez (pdal translate entrada.laz salida.copc.laz)")
+        print("   para leer sólo el área de interés en lugar del tile completo\n")
+
+    # PROCESAMIENTO (un proceso por archivo, cada tile es independiente)
+    raster_outputs = []
+    max_workers = min(os.cpu_count() or 1, max(len(pending), 1))
+    # Sólo se agrupan tiles con la CLI (un arranque de pdal por pipeline) y cuando
+    # sobran respecto a los procesos; en memoria agrupar sólo multiplica el pico de RAM
+    batch_size = 1
+    if pdal is None:
+        batch_size = max(1, min(TILE_BATCH_SIZE, len(pending) // max_workers))
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    print(f"⚙️  Procesando con {max_workers} procesos en paralelo ({batch_size} archivo(s) por pipeline)\n")
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(
+                process_tile_batch, batch, OUTPUT_FOLDER, RESOLUTION, AOI,
+                {f: tile_index.get(str(f), {}).get("bounds") for f in batch}
+            ): batch
+            for batch in batches
+        }
+        done = 0
+        for future in as_completed(futures):
+            batch = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"❌ Error procesando {', '.join(f.name for f in batch)}: {e}\n")
+                results = [(laz_file, None) for laz_file in batch]
+            for laz_file, raster_output in results:
+                done += 1
+                if raster_output is not None:
+                    raster_outputs.append(raster_output)
+                    print(f"✅ [{done}/{len(pending)}] Completado: {laz_file.name}\n")
+                else:
+                    print(f"⚠️  [{done}/{len(pending)}] No se pudo procesar {laz_file.name}\n")
+
+    # RELLENO DE DATOS FALTANTES
+    if raster_outputs:
+        print(f"\n{'='*70}")
+        print(f"🔧 Iniciando relleno de datos faltantes (fillnodata)")
+        print(f"{'='*70}\n")
         
-        for i, raster_file in enumerate(raster_outputs, 1):
-            print(f"🔄 [{i}/{len(raster_outputs)}] Rellenando: {raster_file.name}")
-            
-            output_nodata = NODATA_FOLDER / f"{raster_file.stem}_nodata.tif"
-            
-            cmd_fillnodata = fillnodata_cmd + [
-                "-md", str(FILL_DISTANCE),
-                "-si", "0",
-                str(raster_file),
-                str(output_nodata)
-            ]
-            
-            if run_command(cmd_fillnodata, "relleno de NoData"):
-                print(f"✅ Completado: {output_nodata.name}\n")
+        # rasterio rellena en el mismo proceso; gdal_fillnodata queda como alternativa
+        fillnodata_cmd = None
+        if rasterio is not None:
+            print("✓ Usando rasterio.fill.fillnodata\n")
+        else:
+            fillnodata_cmd = get_fillnodata_command()
+            if fillnodata_cmd is None:
+                print("❌ No se pudo encontrar gdal_fillnodata en el sistema")
+                print("   Instala GDAL Python utilities (pip install gdal) o rasterio")
             else:
-                print(f"⚠️  No se pudo rellenar {raster_file.name}\n")
-
-# LIMPIEZA DE ARCHIVOS TEMPORALES
-print("🧹 Limpiando archivos temporales...")
-for temp_file in TEMP_FOLDER.glob("*.json"):
-    temp_file.unlink()
-
-# FIN
-print(f"{'='*70}")
-print("🎉 ¡Proceso finalizado!")
-print(f"📁 Resultados en: {OUTPUT_FOLDER}")
-print(f"📁 Rasters rellenados en: {NODATA_FOLDER}")
-print(f"📊 Archivos procesados: {len(raster_outputs)}/{len(laz_files)}")
-print(f"{'='*70}")
\ No newline at end of file
+                print(f"✓ Usando comando: {' '.join(fillnodata_cmd)}\n")
+        
+        # Rellenar sobre un mosaico VRT: sin bordes entre tiles y un solo raster final
+        fill_inputs = raster_outputs
+        vrt_file = build_vrt(raster_outputs, OUTPUT_FOLDER / "dsm.vrt")
+        if vrt_file is not None:
+            print(f"🧩 Mosaico virtual: {vrt_file.name}\n")
+            fill_inputs = [vrt_file]
+        
+        if rasterio is not None or fillnodata_cmd is not None:
+            # Un raster por proceso; los bloques de cada raster se reparten los núcleos restantes
+            cpus = os.cpu_count() or 1
+            max_workers = min(cpus, len(fill_inputs))
+            tile_workers = max(1, cpus // max_workers)
+            
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(fill_one, raster_file, NODATA_FOLDER, FILL_DISTANCE,
+                                    fillnodata_cmd, tile_workers): raster_file
+                    for raster_file in fill_inputs
+                }
+                for i, future in enumerate(as_completed(futures), 1):
+                    raster_file = futures[future]
+                    try:
+                        output_nodata = future.result()
+                    except Exception as e:
+                        print(f"    ❌ Error rellenando {raster_file.name}: {e}")
+                        output_nodata = None
+                    if output_nodata is not None:
+                        print(f"✅ [{i}/{len(fill_inputs)}] Completado: {output_nodata.name}\n")
+                    else:
+                        print(f"⚠️  [{i}/{len(fill_inputs)}] No se pudo rellenar {raster_file.name}\n")
+
+    # FIN
+    print(f"{'='*70}")
+    print("🎉 ¡Proceso finalizado!")
+    print(f"📁 Resultados en: {OUTPUT_FOLDER}")
+    print(f"📁 Rasters rellenados en: {NODATA_FOLDER}")
+    print(f"📊 Archivos procesados: {len(raster_outputs)}/{len(laz_files)}")
+    print(f"{'='*70}")
+
+
+# Necesario para ProcessPoolExecutor en Windows (spawn reimporta el módulo)
+if __name__ == "__main__":
+    main()